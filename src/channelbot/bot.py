@@ -1,15 +1,18 @@
 from __future__ import annotations
 
 import asyncio
+import heapq
 import os
-from collections import Counter
+import time
+from collections import defaultdict
 from contextlib import suppress
-from datetime import timedelta, datetime
-from functools import wraps, lru_cache
-from string import Template
-from typing import Sequence
+from datetime import timedelta, datetime, timezone
+from functools import wraps
+from itertools import count
+from typing import Sequence, List, Set, Tuple, Dict, Optional, DefaultDict, Callable
+from weakref import WeakValueDictionary
 
-from cattr import unstructure, structure
+from attr import evolve
 from discord import (
     Message,
     Member,
@@ -20,68 +23,75 @@ from discord import (
     Game,
     Intents,
     NotFound,
+    HTTPException,
     ActivityType,
 )
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import Context, CommandNotFound
 
-from channelbot.data import ManagedChannelType, ChannelConfig, ManagedChannel
+from channelbot.data import ManagedChannelType, ChannelConfig, ManagedChannel, compile_template
 from channelbot.db import ChannelDatabase
 
-
-async def spawn_channel(spawner: ManagedChannel, guild: Guild, db: ChannelDatabase, *members: Member) -> ManagedChannel:
+RECONCILE_INTERVAL = timedelta(minutes=10).total_seconds()
+# Per guild, so one busy guild can't starve the others
+RENAME_CONCURRENCY = 2
+UPDATE_CONCURRENCY = 8
+RENAME_DELAY = 5.0
+WRITE_DELAY = 0.2
+WRITE_BATCH_SIZE = 50
+GAME_ACTIVITY_TYPES = frozenset((ActivityType.playing, ActivityType.streaming))
+
+
+async def spawn_channel(
+    spawner: ManagedChannel,
+    guild: Guild,
+    db: ChannelDatabase,
+    enqueue_write: Callable[[ManagedChannel], None],
+    *members: Member,
+) -> ManagedChannel:
     source_channel = spawner.voice_channel(guild)
 
-    channel_numbers = [el.config.channel_number for el in db.get_children(spawner)]
-    channel_number = len(channel_numbers) + 1
-    for i in range(1, channel_number):
-        if i not in channel_numbers:
-            channel_number = i
-            break
+    used_numbers = db.get_child_numbers(spawner)
+    # Stops at the first gap, so at most len(used_numbers) + 1 set probes
+    channel_number = next(i for i in count(1) if i not in used_numbers)
 
-    new_config = structure(unstructure(spawner.config), ChannelConfig)
-    new_config.channel_type = ManagedChannelType.CHILD
-    new_config.spawner = (spawner.guild_id, spawner.channel_id)
-    new_config.channel_number = channel_number
+    new_config = evolve(
+        spawner.config,
+        channel_type=ManagedChannelType.CHILD,
+        spawner=(spawner.guild_id, spawner.channel_id),
+        channel_number=channel_number,
+    )
 
-    game_status = "General"
-    for activity in members[0].activities:  # FIXME: Use all members
-        if not all((activity, isinstance(activity, Game))):
-            continue
-        game: Game = activity
-        game_status = game.name
+    # FIXME: Use all members
+    game_status = next((a.name for a in members[0].activities if isinstance(a, Game)), "General")
 
     channel_name = new_config.make_channel_name(game=game_status)
-    new_channel: VoiceChannel = await source_channel.clone(name=channel_name)
-    await new_channel.edit(position=source_channel.position + 1)
+    position = source_channel.position + 1
+    # Channels are ordered by (position, id) and the new channel has the largest id, so it only lands directly
+    # under the spawner when nothing else sorts between the spawner and (position, new id)
+    needs_move = any(
+        (source_channel.position, source_channel.id) < (c.position, c.id) and c.position <= position
+        for c in guild.voice_channels
+    )
+    new_channel: VoiceChannel = await guild.create_voice_channel(
+        channel_name,
+        overwrites=source_channel.overwrites,
+        category=source_channel.category,
+        bitrate=source_channel.bitrate,
+        user_limit=source_channel.user_limit,
+        position=position,
+    )
+    if needs_move:
+        # Renumbers the voice channels so the new one sits right below the spawner, like the old clone() + edit()
+        await new_channel.edit(position=position)
     managed_channel = ManagedChannel(guild.id, new_channel.id, new_config)
-    db.insert_channel(managed_channel)
-    for member in members:
-        await member.move_to(new_channel)
+    # Queued before the move so the resulting voice state updates see a managed channel
+    enqueue_write(managed_channel)
+    await asyncio.gather(*(member.move_to(new_channel) for member in members))
     return managed_channel
 
 
-def async_loop(*, hours: int = 0, minutes: int = 0, seconds: int = 0):
-    seconds = timedelta(hours=hours, minutes=minutes, seconds=seconds).seconds
-    if seconds <= 0:
-        raise ValueError("Loop time must be greater than zero")
-
-    def wrapper(func):
-        @wraps(func)
-        async def wrapped(self, *args, **kwargs):
-            while not self.bot.is_ready():
-                await asyncio.sleep(1)
-
-            while not self.bot.is_closed():
-                await func(self, *args, **kwargs)
-                await asyncio.sleep(seconds)
-
-        return wrapped
-
-    return wrapper
-
-
-def channel_only_command(command_prefix: str):
+def channel_only_command(command_prefix: str, *, manage_channels: bool = False):
     def wrapper(func):
         @wraps(func)
         async def wrapped(self, ctx, *args, **kwargs):
@@ -92,6 +102,9 @@ def channel_only_command(command_prefix: str):
             except AttributeError:
                 await message.author.send(f"Error: !{command_prefix} cannot be used in a private message")
                 return
+            if manage_channels and not message.author.guild_permissions.manage_channels:
+                await message.channel.send("Error: You do not have permissions to manage channels")
+                return
             await func(self, ctx, *args, **kwargs)
 
         return wrapped
@@ -99,47 +112,92 @@ def channel_only_command(command_prefix: str):
     return wrapper
 
 
+def member_game(member: Member) -> str:
+    for activity in member.activities:
+        if activity.type in GAME_ACTIVITY_TYPES:
+            return activity.name
+    return "General"
+
+
 def game_status_from_members(members: Sequence[Member]) -> str:
-    c = Counter()
+    if not members:
+        return "General"
+    if len(members) == 1:
+        return member_game(members[0])
+    counts: Dict[str, int] = {}
     for member in members:
-        for activity in member.activities:
-            if activity.type == ActivityType.playing or activity.type == ActivityType.streaming:
-                c[activity.name] += 1
-                break
-        else:
-            c["General"] += 1
-    most_common = c.most_common(1)
-    if most_common:
-        name, count = most_common[0]
-        return name
-    return "General"
+        name = member_game(member)
+        counts[name] = counts.get(name, 0) + 1
+    # max() keeps the first of equal counts, the same tie-break most_common(1) had
+    return max(counts, key=counts.__getitem__)
 
 
-async def update_channel_name(guild: Guild, channel: ManagedChannel):
-    voice_channel = channel.voice_channel(guild)
-    game_status = game_status_from_members(voice_channel.members)
+def pending_channel_name(
+    voice_channel: VoiceChannel, channel: ManagedChannel, members: Optional[Sequence[Member]] = None
+) -> Optional[str]:
+    game_status = "General"
+    if channel.config.uses_game:
+        game_status = game_status_from_members(voice_channel.members if members is None else members)
     new_channel_name = channel.config.make_channel_name(game=game_status)
     if voice_channel.name != new_channel_name:
+        return new_channel_name
+    return None
+
+
+def members_by_channel(guild: Guild) -> DefaultDict[int, List[Member]]:
+    # One walk over the guild's voice states, VoiceChannel.members repeats this walk for every channel
+    members: DefaultDict[int, List[Member]] = defaultdict(list)
+    for user_id, state in guild._voice_states.items():
+        if state.channel is None:
+            continue
+        member = guild.get_member(user_id)
+        if member is not None:
+            members[state.channel.id].append(member)
+    return members
+
+
+async def update_channel_name(voice_channel: VoiceChannel, channel: ManagedChannel):
+    new_channel_name = pending_channel_name(voice_channel, channel)
+    if new_channel_name is not None:
         await voice_channel.edit(name=new_channel_name)
 
 
-@lru_cache(maxsize=64)
-def lock(guild_id: int, channel_id: int):
-    return asyncio.Lock()
+# Locks stay alive only while some coroutine holds a reference to them
+_locks: WeakValueDictionary[Tuple[int, int], asyncio.Lock] = WeakValueDictionary()
+
+
+def lock(guild_id: int, channel_id: int) -> asyncio.Lock:
+    channel_lock = _locks.get((guild_id, channel_id))
+    if channel_lock is None:
+        channel_lock = asyncio.Lock()
+        _locks[(guild_id, channel_id)] = channel_lock
+    return channel_lock
 
 
 class ChannelBot:
     def __init__(self):
         self.db: ChannelDatabase = ChannelDatabase()
+        # Deadlines of CHILD channels which may need cleanup, and channels whose state needs a refresh
+        self._expiry_heap: List[Tuple[float, int, int]] = []
+        self._dirty: Set[Tuple[int, int]] = set()
+        self._next_reconcile: float = 0.0
+        self._flush_lock = asyncio.Lock()
+        self._pending_renames: Dict[Tuple[int, int], asyncio.Task] = {}
+        # Hash of the inputs to the last name check which needed no rename, see update_channel
+        self._name_states: Dict[Tuple[int, int], int] = {}
+        self.index_channels()
         intents = Intents.default()
         intents.voice_states = True
-        intents.presences = True
+        # PRESENCE_UPDATE is by far the noisiest gateway event, and it's only needed to fill in ${game}
+        intents.presences = self.needs_presence()
         intents.members = True
         self.bot = commands.Bot(command_prefix="!", intents=intents)
 
         self.bot.event(self.on_voice_state_update)
         self.bot.event(self.on_command_error)
         self.bot.event(self.on_ready)
+        self.bot.event(self.on_member_update)
+        self.bot.event(self.on_guild_channel_delete)
         self.bot.command(name="cbspawner", help="Create a new dynamic channel")(self.create_spawner)
         self.bot.command(name="cbrename", help="Rename your current channel")(self.rename)
         self.bot.command(
@@ -157,13 +215,56 @@ class ChannelBot:
         )
         self.bot.command(name="cbimport", help="Import a channel")(self.import_channel)
         self.bot.command(name="cborphan", help="Orphan a channel")(self.orphan_channel)
-        self.bot.loop.create_task(self.update_loop())
+        self.update_loop.start()
+        self.bot.loop.create_task(self.write_loop())
 
     def run(self):
         token = os.getenv("DISCORD_TOKEN")
-        self.bot.run(token)
+        try:
+            self.bot.run(token)
+        finally:
+            self.db.close()
+
+    def needs_presence(self) -> bool:
+        channels = list(self.db.scan())
+        # Without any spawners the next one will get the default template, which uses ${game}
+        if not any(c.config.channel_type == ManagedChannelType.SPAWNER for c in channels):
+            return True
+        return any(c.config.uses_game for c in channels)
+
+    async def check_presence_intent(self, ctx: Context, config: ChannelConfig):
+        if config.uses_game and not self.bot.intents.presences:
+            warning = "Warning: A template uses ${game} but the presences intent is disabled, restart to enable it"
+            print(warning)
+            await ctx.message.channel.send(warning)
+
+    def enqueue_write(self, channel: ManagedChannel):
+        if self.db.queue_channel(channel) >= WRITE_BATCH_SIZE:
+            self.bot.loop.create_task(self.flush_writes())
+
+    async def flush_writes(self):
+        # The lock keeps successive flushes in order, the sqlite commit runs off the loop
+        async with self._flush_lock:
+            pending = self.db.take_pending()
+            if not pending:
+                return
+            try:
+                await asyncio.to_thread(self.db.persist, pending)
+            except Exception as e:
+                # Errors stop here so write_loop keeps running, the batch is retried with the next flush
+                print(f"Failed to write {len(pending)} channel changes: {e!r}")
+                self.db.restore_pending(pending)
+
+    async def write_loop(self):
+        while not self.bot.is_closed():
+            # Anything queued within one delay window is coalesced into a single write
+            await asyncio.sleep(WRITE_DELAY)
+            if self.db.has_pending():
+                await self.flush_writes()
 
     async def on_ready(self):
+        await self.flush_writes()
+        self._next_reconcile = 0.0
         await self.update_task()
 
     async def on_command_error(self, ctx: Context, error: BaseException):
@@ -180,7 +281,13 @@ class ChannelBot:
 
         if managed_channel.config.channel_type == ManagedChannelType.SPAWNER:
             async with lock(guild.id, channel.id):
-                await spawn_channel(managed_channel, guild, self.db, *channel.members)
+                # Joins that queued behind another spawn find their members already moved out
+                members = channel.members
+                if members:
+                    await spawn_channel(managed_channel, guild, self.db, self.enqueue_write, *members)
+            return
+
+        self.schedule_rename(managed_channel)
 
     async def on_channel_leave(self, member: Member, channel: VoiceChannel):
         guild: Guild = member.guild
@@ -194,35 +301,107 @@ class ChannelBot:
 
         async with lock(guild.id, channel.id):
             if channel.members:
-                await update_channel_name(guild, managed_channel)
+                self.schedule_rename(managed_channel)
                 return
 
             if not managed_channel.config.is_expired:
+                heapq.heappush(self._expiry_heap, (managed_channel.config.expiry_ts, guild.id, channel.id))
                 return
 
             with suppress(NotFound):
                 await channel.delete()
             self.db.remove_channel(managed_channel)
 
+    def schedule_rename(self, channel: ManagedChannel):
+        # Later changes within the delay are picked up when the pending rename runs
+        key = (channel.guild_id, channel.channel_id)
+        if key not in self._pending_renames:
+            self._pending_renames[key] = self.bot.loop.create_task(self.delayed_rename(key))
+
+    async def delayed_rename(self, key: Tuple[int, int]):
+        await asyncio.sleep(RENAME_DELAY)
+        del self._pending_renames[key]
+        try:
+            channel = self.db.get_channel(*key)
+        except KeyError:
+            return
+        # discord.py may have replaced the channel object during the delay, e.g. when the guild became available again
+        guild = self.bot.get_guild(channel.guild_id)
+        voice_channel = None if guild is None else channel.voice_channel(guild)
+        if voice_channel is None:
+            return
+        async with lock(*key):
+            try:
+                await update_channel_name(voice_channel, channel)
+            except HTTPException as e:
+                print(f"Failed to rename channel: {e!r}")
+
     async def on_voice_state_update(self, member: Member, before: VoiceState, after: VoiceState):
         if before.channel == after.channel:
             return
 
-        if before.channel is not None:
+        guild_id = member.guild.id
+        if before.channel is not None and self.db.is_managed(guild_id, before.channel.id):
             await self.on_channel_leave(member, before.channel)
 
-        if after.channel is not None:
+        if after.channel is not None and self.db.is_managed(guild_id, after.channel.id):
             await self.on_channel_join(member, after.channel)
 
-    @channel_only_command("cbspawner")
+    async def on_guild_channel_delete(self, channel):
+        key = (channel.guild.id, channel.id)
+        self._name_states.pop(key, None)
+        if self.db.is_managed(*key):
+            # Let the next update drop it from the database
+            self._dirty.add(key)
+
+    async def on_member_update(self, before: Member, after: Member):
+        # Activity changes can affect the ${game} portion of the channel name
+        if after.voice is None or after.voice.channel is None:
+            return
+        key = (after.guild.id, after.voice.channel.id)
+        if self.db.is_managed(*key):
+            # Activities aren't part of the cached name state, so force a fresh check
+            self._name_states.pop(key, None)
+            self._dirty.add(key)
+
+    async def resolve_voice_channel(self, ctx: Context) -> Optional[VoiceChannel]:
+        message: Message = ctx.message
+        voice: Optional[VoiceState] = message.author.voice
+        if voice is None or voice.channel is None:
+            await message.channel.send(
+                f"Error: !{ctx.command.name} can only be used when connected to a voice channel"
+            )
+            return None
+        return voice.channel
+
+    async def resolve_channel(
+        self,
+        ctx: Context,
+        *,
+        allowed_types: Optional[Set[ManagedChannelType]] = None,
+        not_managed_error: str = "Error: Channel is not managed by ChannelBot",
+        wrong_type_error: str = "Error: Command not allowed in non-child channels",
+    ) -> Optional[Tuple[VoiceChannel, ManagedChannel]]:
+        message: Message = ctx.message
+        channel = await self.resolve_voice_channel(ctx)
+        if channel is None:
+            return None
+
+        try:
+            managed_channel = self.db.get_channel(ctx.guild.id, channel.id)
+        except KeyError:
+            await message.channel.send(not_managed_error)
+            return None
+
+        if allowed_types is not None and managed_channel.config.channel_type not in allowed_types:
+            await message.channel.send(wrong_type_error)
+            return None
+        return channel, managed_channel
+
+    @channel_only_command("cbspawner", manage_channels=True)
     async def create_spawner(self, ctx: Context, *args: str):
         message: Message = ctx.message
         guild: Guild = ctx.guild
-        author: Member = message.author
-
-        if not author.guild_permissions.manage_channels:
-            await message.channel.send("Error: You do not have permissions to manage channels")
-            return
 
         overwrites = {
             guild.me: PermissionOverwrite(connect=True, manage_channels=True, move_members=True, view_channel=True)
@@ -232,91 +411,65 @@ class ChannelBot:
         new_spawner = ManagedChannel(
             guild_id=guild.id, channel_id=channel.id, config=ChannelConfig(channel_type=ManagedChannelType.SPAWNER)
         )
-        self.db.insert_channel(new_spawner)
+        self.enqueue_write(new_spawner)
+        await self.check_presence_intent(ctx, new_spawner.config)
 
         await message.channel.send(f"New channel spawner created")
 
-    @channel_only_command("cbtemplate")
+    @channel_only_command("cbtemplate", manage_channels=True)
     async def update_template(self, ctx: Context, *args: str):
         message: Message = ctx.message
-        guild: Guild = ctx.guild
-        author: Member = message.author
-        channel = author.voice.channel
-
-        if not author.guild_permissions.manage_channels:
-            await message.channel.send("Error: You do not have permissions to manage channels")
-            return
-
-        if not channel:
-            await message.channel.send("Error: !cbtemplate can only be used when connected to a voice channel")
-            return
-
-        try:
-            managed_channel = self.db.get_channel(guild.id, channel.id)
-        except KeyError:
-            await message.channel.send("Error: Channel is not managed by ChannelBot")
+        resolved = await self.resolve_channel(ctx)
+        if resolved is None:
             return
+        _, managed_channel = resolved
         spawner = managed_channel.get_spawner(self.db)
 
-        spawner.config.template = " ".join(args)
-        try:
-            Template(spawner.config.template).substitute(no=1, game="General")
-        except (KeyError, ValueError):
+        template = " ".join(args)
+        if compile_template(template) is None:
             await message.channel.send("Error: Invalid template provided")
             return
 
-        self.db.insert_channel(spawner)
+        spawner = evolve(spawner, config=evolve(spawner.config, template=template))
+        self.enqueue_write(spawner)
+        await self.check_presence_intent(ctx, spawner.config)
         await message.channel.send("Template updated")
 
     @channel_only_command("cbrename")
     async def rename(self, ctx: Context, *args: str):
         message: Message = ctx.message
         guild: Guild = ctx.guild
-        author: Member = message.author
-        channel = author.voice.channel
-
-        if not channel:
-            await message.channel.send("Error: !cbrename can only be used when connected to a voice channel")
-            return
-
-        try:
-            managed_channel = self.db.get_channel(guild.id, channel.id)
-        except KeyError:
-            await message.channel.send("Error: Channel is not managed by ChannelBot")
-            return
-
-        if managed_channel.config.channel_type not in {ManagedChannelType.CHILD, ManagedChannelType.IMPORT}:
-            await message.channel.send("Error: Channel must be a child or imported channel")
+        resolved = await self.resolve_channel(
+            ctx,
+            allowed_types={ManagedChannelType.CHILD, ManagedChannelType.IMPORT},
+            wrong_type_error="Error: Channel must be a child or imported channel",
+        )
+        if resolved is None:
             return
+        channel, managed_channel = resolved
 
-        managed_channel.config.template = " ".join(args)
-        try:
-            Template(managed_channel.config.template).substitute(no=1, game="General")
-        except (KeyError, ValueError):
+        template = " ".join(args)
+        if compile_template(template) is None:
             await message.channel.send("Error: Invalid template provided")
             return
 
-        self.db.insert_channel(managed_channel)
+        managed_channel = evolve(managed_channel, config=evolve(managed_channel.config, template=template))
+        self.enqueue_write(managed_channel)
+        await self.check_presence_intent(ctx, managed_channel.config)
         await message.channel.send("Template updated")
-        await update_channel_name(guild, managed_channel)
-
+        await update_channel_name(channel, managed_channel)
 
     @channel_only_command("cblimit")
     async def limit_channel(self, ctx: Context, *args: str):
         message: Message = ctx.message
-        guild: Guild = ctx.guild
-        author: Member = message.author
-        channel: VoiceChannel = author.voice.channel
-
-        try:
-            managed_channel = self.db.get_channel(guild.id, channel.id)
-        except KeyError:
-            await message.channel.send("Error: You must be in a ChannelBot-managed session to set limit")
-            return
-
-        if not managed_channel.config.channel_type == ManagedChannelType.CHILD:
-            await message.channel.send("Error: Command not allowed in non-child channels")
+        resolved = await self.resolve_channel(
+            ctx,
+            allowed_types={ManagedChannelType.CHILD},
+            not_managed_error="Error: You must be in a ChannelBot-managed session to set limit",
+        )
+        if resolved is None:
             return
+        channel, _ = resolved
 
         if len(args) != 1:
             await message.channel.send("Usage: !cblimit <limit>")
@@ -337,18 +490,14 @@ class ChannelBot:
     async def hold_channel(self, ctx: Context, *args: str):
         message: Message = ctx.message
         guild: Guild = ctx.guild
-        author: Member = message.author
-        channel: VoiceChannel = author.voice.channel
-
-        try:
-            managed_channel = self.db.get_channel(guild.id, channel.id)
-        except KeyError:
-            await message.channel.send("Error: You must be in a ChannelBot-managed session to set limit")
-            return
-
-        if not managed_channel.config.channel_type == ManagedChannelType.CHILD:
-            await message.channel.send("Error: Command not allowed in non-child channels")
+        resolved = await self.resolve_channel(
+            ctx,
+            allowed_types={ManagedChannelType.CHILD},
+            not_managed_error="Error: You must be in a ChannelBot-managed session to set a hold",
+        )
+        if resolved is None:
             return
+        channel, managed_channel = resolved
 
         if len(args) != 1:
             await message.channel.send("Usage: !cbhold <DD:HH:MM>")
@@ -360,32 +509,24 @@ class ChannelBot:
             await message.channel.send("Usage: !cbhold <DD:HH:MM>")
             return
 
-        if managed_channel.config.hold_until is None:
-            managed_channel.config.hold_until = (
-                datetime.utcnow() + timedelta(days=days, hours=hours, minutes=minutes)
-            ).timestamp()
-        else:
-            managed_channel.config.hold_until = (
-                datetime.utcfromtimestamp(managed_channel.config.hold_until)
-                + timedelta(days=days, hours=hours, minutes=minutes)
-            ).timestamp()
+        hold_start = managed_channel.config.hold_until or time.time()
+        hold_until = hold_start + 86400 * days + 3600 * hours + 60 * minutes
+        managed_channel = evolve(managed_channel, config=evolve(managed_channel.config, hold_until=hold_until))
 
-        self.db.insert_channel(managed_channel)
+        self.enqueue_write(managed_channel)
+        heapq.heappush(self._expiry_heap, (managed_channel.config.expiry_ts, guild.id, channel.id))
         await message.channel.send(
             "Hold will expire at {} UTC".format(
-                datetime.utcfromtimestamp(managed_channel.config.hold_until).strftime("%Y-%m-%dT%H:%M:%S")
+                datetime.fromtimestamp(managed_channel.config.hold_until, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
             )
         )
 
-    @channel_only_command("cbimport")
+    @channel_only_command("cbimport", manage_channels=True)
     async def import_channel(self, ctx: Context, *args: str):
         message: Message = ctx.message
         guild: Guild = ctx.guild
-        author: Member = message.author
-        channel: VoiceChannel = author.voice.channel
-
-        if not author.guild_permissions.manage_channels:
-            await message.channel.send("Error: You do not have permissions to manage channels")
+        channel = await self.resolve_voice_channel(ctx)
+        if channel is None:
             return
 
         try:
@@ -401,64 +542,163 @@ class ChannelBot:
             channel_id=channel.id,
             config=ChannelConfig(channel_type=ManagedChannelType.IMPORT, template=channel.name, channel_number=0),
         )
-        self.db.insert_channel(imported_channel)
+        self.enqueue_write(imported_channel)
         await message.channel.send("Channel imported")
 
-    @channel_only_command("cborphan")
+    @channel_only_command("cborphan", manage_channels=True)
     async def orphan_channel(self, ctx: Context, *args: str):
         message: Message = ctx.message
-        guild: Guild = ctx.guild
-        author: Member = message.author
-        channel: VoiceChannel = author.voice.channel
-
-        if not author.guild_permissions.manage_channels:
-            await message.channel.send("Error: You do not have permissions to manage channels")
-            return
-
-        try:
-            managed_channel = self.db.get_channel(guild.id, channel.id)
-        except KeyError:
-            await message.channel.send("Error: The channel you are in is already not managed by ChannelBot")
+        resolved = await self.resolve_channel(
+            ctx, not_managed_error="Error: The channel you are in is already not managed by ChannelBot"
+        )
+        if resolved is None:
             return
+        _, managed_channel = resolved
 
         self.db.remove_channel(managed_channel)
         await message.channel.send("Channel orphaned")
 
-    @async_loop(minutes=1)
+    @tasks.loop(minutes=1)
     async def update_loop(self):
         await self.update_task()
 
-    async def update_task(self):
-        all_managed_channels = list(self.db.scan())
-        for channel in all_managed_channels:
-            guild = self.bot.get_guild(channel.guild_id)
+    @update_loop.before_loop
+    async def before_update_loop(self):
+        await self.bot.wait_until_ready()
+
+    def index_channels(self):
+        channels = list(self.db.scan())
+        self._expiry_heap = [
+            (c.config.expiry_ts, c.guild_id, c.channel_id)
+            for c in channels
+            if c.config.channel_type == ManagedChannelType.CHILD
+        ]
+        heapq.heapify(self._expiry_heap)
+        self._dirty.update((c.guild_id, c.channel_id) for c in channels)
+
+    def prune_channels(self):
+        guilds = {g.id: g for g in self.bot.guilds}
+        live_channels = {(g.id, c.id) for g in guilds.values() for c in g.voice_channels}
+        for channel in list(self.db.scan()):
+            guild = guilds.get(channel.guild_id)
             if guild is None:
                 print("Removing invalid channel (no guild)")
-                with suppress(KeyError):
-                    self.db.remove_channel(channel)
+            elif guild.unavailable or (channel.guild_id, channel.channel_id) in live_channels:
                 continue
-            voice_channel = channel.voice_channel(guild)
-            if voice_channel is None:
+            else:
                 print("Removing invalid channel (no channel)")
-                with suppress(KeyError):
-                    self.db.remove_channel(channel)
-                continue
+            with suppress(KeyError):
+                self.db.remove_channel(channel)
 
-            async with lock(guild.id, voice_channel.id):
-                if (
-                    channel.config.channel_type == ManagedChannelType.CHILD
-                    and len(voice_channel.members) == 0
-                    and channel.config.is_expired
-                ):
-                    with suppress(NotFound, KeyError):
-                        await voice_channel.delete(reason="Automated channel cleanup")
+    async def update_task(self):
+        now = time.time()
+        if now >= self._next_reconcile:
+            # Coarse safety net for anything the event handlers missed
+            self.prune_channels()
+            self.index_channels()
+            self._next_reconcile = now + RECONCILE_INTERVAL
+
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, guild_id, channel_id = heapq.heappop(self._expiry_heap)
+            self._dirty.add((guild_id, channel_id))
+
+        dirty, self._dirty = self._dirty, set()
+        channels_by_guild: DefaultDict[int, List[ManagedChannel]] = defaultdict(list)
+        for guild_id, channel_id in dirty:
+            with suppress(KeyError):
+                channels_by_guild[guild_id].append(self.db.get_channel(guild_id, channel_id))
+
+        # Each guild is resolved once per tick and handed to update_channel with its channels
+        channels: List[Tuple[ManagedChannel, Guild]] = []
+        voice_members: Dict[int, DefaultDict[int, List[Member]]] = {}
+        for guild_id, guild_channels in channels_by_guild.items():
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                print(f"Removing {len(guild_channels)} invalid channels (no guild)")
+                for channel in guild_channels:
+                    with suppress(KeyError):
                         self.db.remove_channel(channel)
-                    continue
+                continue
+            if guild.unavailable:
+                # An unavailable guild has no channels loaded, the next reconcile after it comes back checks them again
+                continue
+            voice_members[guild_id] = members_by_channel(guild)
+            channels.extend((channel, guild) for channel in guild_channels)
+
+        renames: Dict[Tuple[int, int], Tuple[VoiceChannel, str]] = {}
+        semaphore = asyncio.Semaphore(UPDATE_CONCURRENCY)
+
+        async def update(channel: ManagedChannel, guild: Guild):
+            async with semaphore:
+                await self.update_channel(channel, guild, renames, voice_members[guild.id])
+
+        results = await asyncio.gather(*(update(*el) for el in channels), return_exceptions=True)
+        for (channel, _), result in zip(channels, results):
+            if isinstance(result, Exception):
+                print(f"Failed to update channel {channel.channel_id}: {result!r}")
+        await self.flush_renames(renames)
+
+    async def flush_renames(self, renames: Dict[Tuple[int, int], Tuple[VoiceChannel, str]]):
+        semaphores: DefaultDict[int, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(RENAME_CONCURRENCY))
+
+        async def rename(voice_channel: VoiceChannel, name: str):
+            async with semaphores[voice_channel.guild.id]:
+                await voice_channel.edit(name=name)
+
+        results = await asyncio.gather(*(rename(*el) for el in renames.values()), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Failed to rename channel: {result!r}")
+
+    async def update_channel(
+        self,
+        channel: ManagedChannel,
+        guild: Guild,
+        renames: Dict[Tuple[int, int], Tuple[VoiceChannel, str]],
+        guild_members: DefaultDict[int, List[Member]],
+    ):
+        key = (channel.guild_id, channel.channel_id)
+        # Looked up on every visit, discord.py replaces channel objects when a guild becomes available again
+        voice_channel = channel.voice_channel(guild)
+        if voice_channel is None:
+            print("Removing invalid channel (no channel)")
+            with suppress(KeyError):
+                self.db.remove_channel(channel)
+            return
 
-                if channel.config.channel_type in {ManagedChannelType.CHILD, ManagedChannelType.IMPORT}:
-                    await update_channel_name(guild, channel)
-                    continue
+        async with lock(guild.id, voice_channel.id):
+            # Deleting and spawning act on who is connected right now, so they don't use the tick's snapshot
+            if (
+                channel.config.channel_type == ManagedChannelType.CHILD
+                and channel.config.is_expired
+                and not voice_channel.members
+            ):
+                self._name_states.pop(key, None)
+                with suppress(NotFound, KeyError):
+                    await voice_channel.delete(reason="Automated channel cleanup")
+                    self.db.remove_channel(channel)
+                return
+
+            if channel.config.channel_type in {ManagedChannelType.CHILD, ManagedChannelType.IMPORT}:
+                members = guild_members[voice_channel.id]
+                state = hash(
+                    (
+                        voice_channel.name,
+                        channel.config.template,
+                        channel.config.channel_number,
+                        frozenset(m.id for m in members),
+                    )
+                )
+                if self._name_states.get(key) == state:
+                    return
+                new_channel_name = pending_channel_name(voice_channel, channel, members)
+                if new_channel_name is not None:
+                    renames[key] = (voice_channel, new_channel_name)
+                else:
+                    self._name_states[key] = state
+                return
 
-                if channel.config.channel_type == ManagedChannelType.SPAWNER:
-                    if len(voice_channel.members) > 0:
-                        await spawn_channel(channel, guild, self.db, *voice_channel.members)
+            if channel.config.channel_type == ManagedChannelType.SPAWNER:
+                members = voice_channel.members
+                if members:
+                    await spawn_channel(channel, guild, self.db, self.enqueue_write, *members)
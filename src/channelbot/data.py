@@ -1,7 +1,8 @@
 from __future__ import annotations
 
-from datetime import datetime
+import time
 from enum import Enum
+from functools import lru_cache
 from string import Template
 from typing import Optional, Tuple, TYPE_CHECKING
 
@@ -12,13 +13,46 @@ if TYPE_CHECKING:
     from channelbot.db import ChannelDatabase
 
 
+TEMPLATE_VARIABLES = frozenset(("no", "game"))
+
+
+@lru_cache(maxsize=256)
+def compile_template(template: str) -> Optional[str]:
+    # Translates a string.Template into an equivalent str.format string, or None if substitute() would fail
+    parts = []
+    position = 0
+    for match in Template.pattern.finditer(template):
+        parts.append(template[position : match.start()].replace("{", "{{").replace("}", "}}"))
+        position = match.end()
+        name = match.group("named") or match.group("braced")
+        if match.group("escaped") is not None:
+            parts.append("$")
+        elif name in TEMPLATE_VARIABLES:
+            parts.append("{" + name + "}")
+        else:
+            return None
+    parts.append(template[position:].replace("{", "{{").replace("}", "}}"))
+    return "".join(parts)
+
+
+@lru_cache(maxsize=1024)
+def render_channel_name(template: str, channel_number: Optional[int], game: str) -> str:
+    if "$" not in template:
+        # No placeholders, e.g. imported channels which use their original name
+        return template
+    compiled = compile_template(template)
+    if compiled is None:
+        return template
+    return compiled.format_map({"no": channel_number, "game": game})
+
+
 class ManagedChannelType(Enum):
     SPAWNER = "SPAWNER"
     CHILD = "CHILD"
     IMPORT = "IMPORT"
 
 
-@attrs
+@attrs(frozen=True, slots=True)
 class ChannelConfig:
     template = attrib(default="#${no} Talk [${game}]", type=str)
     channel_type = attrib(default=ManagedChannelType.SPAWNER, type=ManagedChannelType)
@@ -28,19 +62,24 @@ class ChannelConfig:
     hold_until = attrib(type=Optional[float], default=None)
 
     def make_channel_name(self, *, game: str = "General"):
-        try:
-            return Template(self.template).substitute(no=self.channel_number, game=game)
-        except (ValueError, KeyError):
-            return self.template
+        return render_channel_name(self.template, self.channel_number, game)
+
+    @property
+    def uses_game(self) -> bool:
+        return "${game}" in self.template or "$game" in self.template
 
     @property
     def is_expired(self) -> bool:
         if self.channel_type == ManagedChannelType.IMPORT:
             return False
-        return self.hold_until is None or datetime.utcnow().timestamp() >= self.hold_until
+        return time.time() >= self.expiry_ts
+
+    @property
+    def expiry_ts(self) -> float:
+        return self.hold_until or 0.0
 
 
-@attrs(frozen=True)
+@attrs(frozen=True, slots=True)
 class ManagedChannel:
     guild_id = attrib(type=int, hash=True)
     channel_id = attrib(type=int, hash=True)
@@ -1,43 +1,158 @@
 from __future__ import annotations
 
+import json
 import os
-from typing import Iterator
+import shutil
+import sqlite3
+from threading import Lock
+from collections import defaultdict
+from typing import Iterator, Dict, Tuple, Optional, DefaultDict, Set, List
 
-from cattr import unstructure, structure
-from tinydb import TinyDB, where
+from cattr import Converter
+from cattr.gen import make_dict_structure_fn, make_dict_unstructure_fn
 
-from channelbot.data import ManagedChannel
+from channelbot.data import ManagedChannel, ChannelConfig
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+CREATE_TABLE = (
+    "CREATE TABLE IF NOT EXISTS channels ("
+    "guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, config TEXT NOT NULL, "
+    "PRIMARY KEY (guild_id, channel_id))"
+)
+DELETE_CHANNEL = "DELETE FROM channels WHERE guild_id = ? AND channel_id = ?"
+UPSERT_CHANNEL = (
+    "INSERT INTO channels VALUES (?, ?, ?) ON CONFLICT (guild_id, channel_id) DO UPDATE SET config = excluded.config"
+)
+
+# Hooks are generated once here instead of being dispatched through the global converter on every call
+converter = Converter()
+converter.register_structure_hook(ChannelConfig, make_dict_structure_fn(ChannelConfig, converter))
+converter.register_unstructure_hook(ChannelConfig, make_dict_unstructure_fn(ChannelConfig, converter))
+structure_channel = make_dict_structure_fn(ManagedChannel, converter)
+unstructure_channel = make_dict_unstructure_fn(ManagedChannel, converter)
+
+
+def channel_rows(docs: List[dict]) -> List[Tuple[int, int, str]]:
+    return [(doc["guild_id"], doc["channel_id"], json.dumps(doc["config"])) for doc in docs]
+
+
+def migrate_tinydb(path: str):
+    # Databases created before the switch to sqlite are TinyDB JSON files, convert them once and keep a backup.
+    # The JSON file stays in place until the converted database is complete, so a failure here loses nothing
+    with open(path, "rb") as f:
+        header = f.read(len(SQLITE_HEADER))
+    if not header or header == SQLITE_HEADER:
+        return
+    with open(path) as f:
+        tables = json.load(f)
+    channels = [structure_channel(doc, ManagedChannel) for table in tables.values() for doc in table.values()]
+
+    migrated_path = path + ".migrating"
+    if os.path.exists(migrated_path):
+        os.remove(migrated_path)
+    conn = sqlite3.connect(migrated_path)
+    try:
+        with conn:
+            conn.execute(CREATE_TABLE)
+            conn.executemany(UPSERT_CHANNEL, channel_rows([unstructure_channel(c) for c in channels]))
+    finally:
+        conn.close()
+    shutil.copy2(path, path + ".tinydb.bak")
+    os.replace(migrated_path, path)
+    print(f"Migrated {len(channels)} channels from TinyDB, the old database was kept as {path}.tinydb.bak")
 
 
 class ChannelDatabase:
     def __init__(self):
-        self._db: TinyDB = TinyDB(os.getenv("CHANNEL_DB_PATH"))
+        path = os.getenv("CHANNEL_DB_PATH")
+        if os.path.exists(path):
+            migrate_tinydb(path)
+        # persist() runs in a worker thread, the write lock serializes all use of the connection
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(CREATE_TABLE)
+        self._write_lock = Lock()
+        # Changes which have been accepted but not yet persisted, None marks a removal. See take_pending/persist
+        self._pending: Dict[Tuple[int, int], Optional[ManagedChannel]] = {}
+        # Every stored channel, so reads never touch sqlite and a miss means the channel is not managed
+        self._cache: Dict[Tuple[int, int], ManagedChannel] = {}
+        # (guild_id, spawner channel_id) -> channel ids of its children
+        self._children: DefaultDict[Tuple[int, int], Set[int]] = defaultdict(set)
+        for guild_id, channel_id, config in self._conn.execute("SELECT guild_id, channel_id, config FROM channels"):
+            el = {"guild_id": guild_id, "channel_id": channel_id, "config": json.loads(config)}
+            self._cache_put(structure_channel(el, ManagedChannel))
+
+    def _cache_put(self, channel: ManagedChannel):
+        self._cache_pop((channel.guild_id, channel.channel_id))
+        self._cache[(channel.guild_id, channel.channel_id)] = channel
+        if channel.config.spawner:
+            self._children[tuple(channel.config.spawner)].add(channel.channel_id)
 
-    def insert_channel(self, channel: ManagedChannel):
-        try:
-            self.remove_channel(channel)
-        except KeyError:
-            pass
-        self._db.insert(unstructure(channel))
+    def _cache_pop(self, key: Tuple[int, int]) -> Optional[ManagedChannel]:
+        channel = self._cache.pop(key, None)
+        if channel is not None and channel.config.spawner:
+            spawner_key = tuple(channel.config.spawner)
+            self._children[spawner_key].discard(channel.channel_id)
+            if not self._children[spawner_key]:
+                del self._children[spawner_key]
+        return channel
+
+    def queue_channel(self, channel: ManagedChannel) -> int:
+        self._pending[(channel.guild_id, channel.channel_id)] = channel
+        self._cache_put(channel)
+        return len(self._pending)
+
+    def has_pending(self) -> bool:
+        return bool(self._pending)
+
+    def take_pending(self) -> Dict[Tuple[int, int], Optional[dict]]:
+        pending, self._pending = self._pending, {}
+        return {key: None if channel is None else unstructure_channel(channel) for key, channel in pending.items()}
+
+    def restore_pending(self, pending: Dict[Tuple[int, int], Optional[dict]]):
+        # Requeues a batch which failed to persist. Keys queued again since take_pending() already hold newer state,
+        # and for every other key the cache still matches the batch, None included for removals
+        for key in pending:
+            if key not in self._pending:
+                self._pending[key] = self._cache.get(key)
+
+    def persist(self, pending: Dict[Tuple[int, int], Optional[dict]]):
+        # Only touches sqlite, so it's safe to run from a worker thread
+        if not pending:
+            return
+        removed = [key for key, doc in pending.items() if doc is None]
+        upserted = channel_rows([doc for doc in pending.values() if doc is not None])
+        with self._write_lock, self._conn:
+            self._conn.executemany(DELETE_CHANNEL, removed)
+            self._conn.executemany(UPSERT_CHANNEL, upserted)
+
+    def flush(self):
+        self.persist(self.take_pending())
+
+    def close(self):
+        self.flush()
+        with self._write_lock:
+            self._conn.close()
 
     def remove_channel(self, channel: ManagedChannel):
-        el = self._db.get((where("channel_id") == channel.channel_id) & (where("guild_id") == channel.guild_id))
-        if el:
-            self._db.remove(doc_ids=[el.doc_id])
-        else:
+        key = (channel.guild_id, channel.channel_id)
+        if self._cache_pop(key) is None:
             raise KeyError(channel.guild_id, channel.channel_id)
+        self._pending[key] = None
+
+    def is_managed(self, guild_id: int, channel_id: int) -> bool:
+        return (guild_id, channel_id) in self._cache
 
     def get_channel(self, guild_id: int, channel_id: int) -> ManagedChannel:
-        el = self._db.get((where("channel_id") == channel_id) & (where("guild_id") == guild_id))
-        if not el:
+        channel = self._cache.get((guild_id, channel_id))
+        if channel is None:
             raise KeyError(guild_id, channel_id)
-        return structure(el, ManagedChannel)
+        return channel
 
-    def get_children(self, spawner: ManagedChannel) -> Iterator[ManagedChannel]:
-        all_raw_channels = self._db.search(where("guild_id") == spawner.guild_id)
-        all_channels = (structure(el, ManagedChannel) for el in all_raw_channels)
-        children = (c for c in all_channels if c.config.spawner and c.config.spawner[1] == spawner.channel_id)
-        yield from sorted(children, key=lambda el: el.config.channel_number)
+    def get_child_numbers(self, spawner: ManagedChannel) -> Set[int]:
+        child_ids = self._children.get((spawner.guild_id, spawner.channel_id), ())
+        return {self._cache[(spawner.guild_id, channel_id)].config.channel_number for channel_id in child_ids}
 
     def scan(self) -> Iterator[ManagedChannel]:
-        yield from (structure(el, ManagedChannel) for el in self._db.search(where("channel_id") > 0))
+        yield from list(self._cache.values())